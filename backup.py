@@ -1,26 +1,84 @@
 import base64
 import logging
 import os
-import shutil
 import tempfile
+import time
+import webbrowser
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from logging.handlers import RotatingFileHandler
 from pathlib import Path
+from urllib.parse import parse_qs, urlparse
 
 import dotenv
 import fitbit
+import orjson
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv
 import requests
 from git import Actor, Repo
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.ui import WebDriverWait
-from webdriver_manager.chrome import ChromeDriverManager
+from oauthlib.oauth2.rfc6749.errors import OAuth2Error
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 log = logging.getLogger(__name__)
 
+# python-fitbit decodes every API response with the stdlib json module,
+# which it only ever uses for loads; orjson parses the same payloads
+# several times faster
+fitbit.api.json = orjson
+
+
+def make_adapter() -> HTTPAdapter:
+    """
+    Builds an HTTP adapter with connection pooling and retries,
+    so consecutive calls reuse the same TCP+TLS connection.
+
+    :return: the configured adapter
+    """
+    return HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=10,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            raise_on_status=False
+        )
+    )
+
+
+session = requests.Session()
+session.mount("https://", make_adapter())
+
+SEED_CSV_URL = "https://raw.githubusercontent.com/jrg94/personal-data/main/health/fitbit.csv"
+
+
+def fetch_seed_csv() -> Path:
+    """
+    Downloads the existing data set from GitHub, caching it on disk
+    and skipping the download when the upstream copy is unchanged.
+
+    :return: the path to the local copy of the data set
+    """
+    cache_path = Path(".cache") / "fitbit.csv"
+    etag_path = cache_path.with_suffix(".csv.etag")
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    headers = {}
+    if cache_path.exists() and etag_path.exists():
+        headers["If-None-Match"] = etag_path.read_text()
+    response = session.get(SEED_CSV_URL, headers=headers)
+    if response.status_code == 304:
+        log.info("Seed CSV is unchanged upstream; reading from cache.")
+    else:
+        response.raise_for_status()
+        cache_path.write_bytes(response.content)
+        if etag := response.headers.get("ETag"):
+            etag_path.write_text(etag)
+    return cache_path
+
 
 def automate_code_retrieval() -> str:
     """
@@ -37,27 +95,28 @@ def automate_code_retrieval() -> str:
         "&scope=activity%20heartrate%20location%20nutrition%20profile%20settings%20sleep%20social%20weight%20oxygen_saturation%20respiratory_rate%20temperature" \
         "&expires_in=604800"
 
-    # Get URL
-    driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()))
-    driver.get(url)
+    codes = {}
+
+    class CallbackHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query)
+            if "code" in query:
+                codes["code"] = query["code"][0]
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain")
+            self.end_headers()
+            self.wfile.write(b"Authorization received. You can close this tab.")
 
-    # Complete login form
-    WebDriverWait(driver, 10).until(
-        EC.presence_of_element_located((By.XPATH, "//input[@type='email']")))
-    username_input = driver.find_element(By.XPATH, "//input[@type='email']")
-    password_input = driver.find_element(By.XPATH, "//input[@type='password']")
-    submit = driver.find_element(
-        By.XPATH, "//form[@id='loginForm']/div/button")
-    username_input.send_keys(os.environ.get("FITBIT_USERNAME"))
-    password_input.send_keys(os.environ.get("FITBIT_PASSWORD"))
-    submit.click()
+        def log_message(self, format, *args):
+            log.debug(format % args)
 
-    # Get code
-    WebDriverWait(driver, 10).until(EC.url_contains("127.0.0.1:8080"))
-    code = driver.current_url.split("code=")[-1].split("#")[0]
-    driver.quit()
+    # Capture the redirect locally while the user logs in
+    with HTTPServer(("127.0.0.1", 8080), CallbackHandler) as server:
+        webbrowser.open(url)
+        while "code" not in codes:
+            server.handle_request()
 
-    return code
+    return codes["code"]
 
 
 def automate_token_retrieval(code: str):
@@ -72,21 +131,73 @@ def automate_token_retrieval(code: str):
         "redirect_uri": "http://127.0.0.1:8080/",
         "code": code
     }
+    response = session.post(data=data, headers=make_token_headers(),
+                            url="https://api.fitbit.com/oauth2/token")
+    keys = response.json()
+    update_env({
+        "FITBIT_ACCESS_TOKEN": keys["access_token"],
+        "FITBIT_REFRESH_TOKEN": keys["refresh_token"],
+        "FITBIT_EXPIRES_AT": str(time.time() + keys["expires_in"])
+    })
+
+
+def make_token_headers() -> dict:
+    """
+    Builds the basic auth headers expected by the Fitbit token endpoint.
+
+    :return: a dictionary of headers
+    """
     basic_token = base64.b64encode(
         f"{os.environ.get('FITBIT_CLIENT_ID')}:{os.environ.get('FITBIT_CLIENT_SECRET')}".encode(
             "utf-8")
     ).decode("utf-8")
-    headers = {
+    return {
         "Content-Type": "application/x-www-form-urlencoded",
         "Authorization": f"Basic {basic_token}"
     }
-    response = requests.post(data=data, headers=headers,
-                             url="https://api.fitbit.com/oauth2/token")
+
+
+def refresh_access_token() -> bool:
+    """
+    Attempts a plain OAuth refresh of the access token, which is
+    far cheaper than re-running the full authorization flow.
+
+    :return: True if the refresh succeeded
+    """
+    log.info("Attempting to refresh the access token.")
+    data = {
+        "grant_type": "refresh_token",
+        "refresh_token": os.environ.get("FITBIT_REFRESH_TOKEN")
+    }
+    response = session.post(data=data, headers=make_token_headers(),
+                            url="https://api.fitbit.com/oauth2/token")
+    if response.status_code in (400, 401):
+        log.warning("Refresh token was rejected.")
+        return False
+    response.raise_for_status()
     keys = response.json()
-    dotenv.set_key(".env", "FITBIT_ACCESS_TOKEN", keys["access_token"])
-    dotenv.set_key(".env", "FITBIT_REFRESH_TOKEN", keys["refresh_token"])
-    dotenv.set_key(".env", "FITBIT_EXPIRES_AT", str(keys["expires_in"]))
-    dotenv.load_dotenv(override=True)
+    update_env({
+        "FITBIT_ACCESS_TOKEN": keys["access_token"],
+        "FITBIT_REFRESH_TOKEN": keys["refresh_token"],
+        "FITBIT_EXPIRES_AT": str(time.time() + keys["expires_in"])
+    })
+    return True
+
+
+def update_env(updates: dict) -> None:
+    """
+    Applies a batch of key updates to the .env file in a single
+    atomic rewrite, keeping the process environment in sync.
+
+    :param updates: a dictionary of keys to update
+    """
+    values = dotenv.dotenv_values(".env")
+    values |= updates
+    fd, tmp = tempfile.mkstemp(dir=".", text=True)
+    with os.fdopen(fd, "w") as env_file:
+        env_file.writelines(f"{key}={value}\n" for key, value in values.items())
+    os.replace(tmp, ".env")
+    os.environ |= updates
 
 
 def refresh_cb(token: dict) -> None:
@@ -98,28 +209,69 @@ def refresh_cb(token: dict) -> None:
     log.info("Refreshing Fitbit tokens.")
     if os.environ.get("FITBIT_ACCESS_TOKEN") != token["access_token"]:
         log.info("Updating FITBIT_ACCESS_TOKEN.")
-        dotenv.set_key(".env", "FITBIT_ACCESS_TOKEN", token["access_token"])
     if os.environ.get("FITBIT_REFRESH_TOKEN") != token["refresh_token"]:
         log.info("Updating FITBIT_REFRESH_TOKEN.")
-        dotenv.set_key(".env", "FITBIT_REFRESH_TOKEN", token["refresh_token"])
-    dotenv.set_key(".env", "FITBIT_EXPIRES_AT", str(token["expires_at"]))
-    dotenv.load_dotenv(override=True)
+    update_env({
+        "FITBIT_ACCESS_TOKEN": token["access_token"],
+        "FITBIT_REFRESH_TOKEN": token["refresh_token"],
+        "FITBIT_EXPIRES_AT": str(token["expires_at"])
+    })
 
 
-def commit_csv() -> None:
+def write_csv(df: pd.DataFrame, path: str) -> None:
     """
-    Commits the fitbit data to the personal data repo.
+    Writes the data set as a CSV using Arrow's multithreaded writer,
+    which is considerably faster than the pandas one.
+
+    :param df: the data set to write
+    :param path: the destination path
+    """
+    out = df.reset_index()
+    out["Date"] = out["Date"].dt.date
+    pa.csv.write_csv(
+        pa.Table.from_pandas(out, preserve_index=False),
+        path,
+        # Arrow quotes every string by default; only quoting when
+        # required keeps the output close to the pandas style
+        write_options=pa.csv.WriteOptions(quoting_style="needed")
+    )
+
+
+def commit_csv(new_df: pd.DataFrame) -> None:
+    """
+    Commits the latest rows of fitbit data to the personal data repo.
+
+    :param new_df: the new and updated rows to merge upstream
     """
+    if new_df.empty:
+        log.info("No new data to commit; skipping the clone.")
+        return
     with tempfile.TemporaryDirectory() as dir:
         repo = Repo.clone_from(
-            "https://github.com/jrg94/personal-data.git", dir
+            "https://github.com/jrg94/personal-data.git",
+            dir,
+            multi_options=["--depth=1", "--filter=blob:none", "--single-branch"]
         )
-        health_data_path = Path(dir) / "health"
-        shutil.copyfile(
-            "fitbit.csv",
-            str(health_data_path / "fitbit.csv")
+        csv_path = Path(dir) / "health" / "fitbit.csv"
+        existing_df = pd.read_csv(
+            csv_path,
+            parse_dates=["Date"],
+            index_col="Date",
+            dtype=DTYPES
         )
-        repo.index.add([str(health_data_path / "fitbit.csv")])
+        # Appended rows are positional, so match the physical column
+        # order of the upstream file rather than assuming it
+        new_df = new_df.reindex(columns=existing_df.columns)
+        if new_df.index.intersection(existing_df.index).empty:
+            # The common case is brand new dates, which only costs an
+            # append of the delta rather than a rewrite of all history
+            new_df.to_csv(csv_path, mode="a", header=False)
+        else:
+            merged_df = pd.concat([existing_df, new_df])
+            merged_df.sort_index(kind="stable", inplace=True)
+            merged_df = merged_df[~merged_df.index.duplicated(keep="last")]
+            write_csv(merged_df, str(csv_path))
+        repo.index.add([str(csv_path)])
         committer = Actor("GitHub Action", "action@github.com")
         commit = repo.index.commit(f"Updated fitbit data automatically", author=committer, committer=committer)
         if not commit.stats.files:
@@ -130,137 +282,216 @@ def commit_csv() -> None:
         repo.close()
 
 
-def get_sleep_data(client, date: str, to_df: dict) -> None:
+def get_sleep_data(client, date: str) -> dict:
     """
     A helper function for retrieving sleep data.
 
     :param date: the date of sleep to pull
-    :param to_df: the dictionary to add the data to
+    :return: a dictionary of sleep data
     """
     day_of_sleep: dict = client.sleep(date)
     log.info(f"Retrieve sleep data for {date}: {day_of_sleep}")
     day_of_sleep = day_of_sleep["summary"]
     day_of_sleep.pop("stages", None)
-    if all(v > 0 for v in day_of_sleep.values()):
-        to_df |= day_of_sleep
+    return day_of_sleep
 
 
-def get_steps_data(client, date: str, to_df: dict) -> None:
+def get_steps_data(client, start, end) -> dict:
     """
-    A helper function for retrieving steps data.
+    A helper function for retrieving steps data for a range of
+    dates in a single request.
 
-    :param date: the date of steps to pull
-    :param to_df: the dictionary to add the data to
+    :param start: the first date of steps to pull
+    :param end: the last date of steps to pull
+    :return: a dictionary mapping each date to its steps data
     """
-    day_of_steps: dict = client.time_series(
+    days_of_steps: dict = client.time_series(
         "activities/steps",
-        base_date=date,
-        period="1d"
+        base_date=start,
+        end_date=end
     )
-    log.info(f"Retrieve steps data for {date}: {day_of_steps}")
-    day_of_steps = day_of_steps["activities-steps"][0]
-    if day_of_steps["value"] != '0':
-        to_df |= day_of_steps
+    log.info(f"Retrieve steps data for {start} to {end}: {days_of_steps}")
+    return {day["dateTime"]: day for day in days_of_steps["activities-steps"]}
 
 
-def get_body_data(client, date: str, to_df: dict) -> None:
+def get_body_data(client, date: str) -> dict:
     """
     A helper function for retrieving body data.
 
     :param date: the date of body data to pull
-    :param to_df: the dictionary to add the data to
+    :return: a dictionary of body data
     """
     day_of_body: dict = client.body(date)
     log.info(f"Retrieve body data for {date}: {day_of_body}")
-    day_of_body = day_of_body["body"]
-    if all(v > 0 for v in day_of_body.values()):
-        to_df |= day_of_body
+    return day_of_body["body"]
 
 
-def get_heart_data(client, date: str, to_df: dict) -> None:
+def get_heart_data(client, start, end) -> dict:
     """
-    A helper function for retrieving heart data.
+    A helper function for retrieving heart data for a range of
+    dates in a single request.
 
-    :param date: the date of heart data to pull
-    :param to_df: the dictionary to add the data to
+    :param start: the first date of heart data to pull
+    :param end: the last date of heart data to pull
+    :return: a dictionary mapping each date to its heart data
     """
-    day_of_heart = client.time_series(
+    days_of_heart = client.time_series(
         "activities/heart",
-        base_date=date,
-        period="1d"
+        base_date=start,
+        end_date=end
     )
-    log.info(f"Retrieve heart data for {date}: {day_of_heart}")
-    day_of_heart = day_of_heart["activities-heart"][0]["value"].get(
-        "restingHeartRate")
-    if day_of_heart:
-        to_df |= {"restingHeartRate": day_of_heart}
+    log.info(f"Retrieve heart data for {start} to {end}: {days_of_heart}")
+    return {
+        day["dateTime"]: {"restingHeartRate": resting}
+        for day in days_of_heart["activities-heart"]
+        if (resting := day["value"].get("restingHeartRate"))
+    }
 
 
-def get_row_of_data(client, date: str) -> tuple[pd.DataFrame, int]:
+COLUMNS = {
+    "dateTime": "Date",
+    "value": "Steps",
+    "bmi": "BMI",
+    "fat": "Body Fat %",
+    "weight": "Weight",
+    "totalMinutesAsleep": "Total Sleep (minutes)",
+    "totalSleepRecords": "Total Sleep Records",
+    "totalTimeInBed": "Total Time in Bed (minutes)",
+    "restingHeartRate": "Resting Heart Rate",
+}
+
+DTYPES = {
+    "Steps": "Int64",
+    "BMI": "float32",
+    "Body Fat %": "float32",
+    "Weight": "float32",
+    "Total Sleep (minutes)": "Int32",
+    "Total Sleep Records": "Int16",
+    "Total Time in Bed (minutes)": "Int32",
+    "Resting Heart Rate": "Int16",
+}
+
+SLEEP_COLUMNS = [
+    "Total Sleep (minutes)",
+    "Total Sleep Records",
+    "Total Time in Bed (minutes)",
+]
+
+BODY_COLUMNS = [
+    "BMI",
+    "Body Fat %",
+    "Weight",
+]
+
+
+def get_row_of_data(client, date, steps: dict, heart: dict) -> tuple[dict, int]:
     """
     Grabs a day's worth of data from the Fitbit API.
 
     :param date: the date to pull data for
-    :return: a dataframe of the data and the number of requests to generate a row
-    """
-    to_df = {}
-    columns = {
-        "dateTime": "Date",
-        "value": "Steps",
-        "bmi": "BMI",
-        "fat": "Body Fat %",
-        "weight": "Weight",
-        "totalMinutesAsleep": "Total Sleep (minutes)",
-        "totalSleepRecords": "Total Sleep Records",
-        "totalTimeInBed": "Total Time in Bed (minutes)",
-        "restingHeartRate": "Resting Heart Rate",
-    }
+    :param steps: a mapping of dates to prefetched steps data
+    :param heart: a mapping of dates to prefetched heart data
+    :return: a dictionary of the data and the number of requests to generate a row
+    """
+    # Sleep and body have no range endpoints, so they are still fetched
+    # per date, concurrently so the row costs one round-trip of latency
+    helpers = (get_sleep_data, get_body_data)
+    with ThreadPoolExecutor(max_workers=len(helpers)) as executor:
+        futures = [executor.submit(helper, client, date) for helper in helpers]
+        sleep, body = (future.result() for future in futures)
 
-    # Fitbit queries
-    get_sleep_data(client, date, to_df)
-    get_steps_data(client, date, to_df)
-    get_body_data(client, date, to_df)
-    get_heart_data(client, date, to_df)
+    key = date.strftime("%Y-%m-%d")
+    to_df = {**sleep, **steps.get(key, {}), **body, **heart.get(key, {})}
 
     if not to_df:
         log.warning(f"No data for {date}")
-        return None, 4
+        return None, 2
     else:
-        df = pd.DataFrame([to_df])
-        df.rename(columns=columns, inplace=True)
-        df["Date"] = pd.to_datetime(df["Date"])
-        df.set_index("Date", inplace=True)
-        log.info(f"Collected a row of data:\n{df}")
-        return df, 4
+        log.info(f"Collected a row of data: {to_df}")
+        return to_df, 2
 
 
 def get_latest_data(client):
     """
-    Takes the existing data and updates it with the latest data.
+    Finds where the existing data leaves off and pulls everything since.
 
-    :return: a dataframe of the complete data set
+    :return: a dataframe of the new and updated rows
     """
     requests = 0
     df = pd.read_csv(
-        "https://raw.githubusercontent.com/jrg94/personal-data/main/health/fitbit.csv")
-    df["Date"] = pd.to_datetime(df["Date"])
-    df.set_index("Date", inplace=True)
+        fetch_seed_csv(),
+        parse_dates=["Date"],
+        index_col="Date",
+        dtype=DTYPES
+    )
     latest_date = df.index[-7]  # last 7 days to account for missing syncs
-    date_range = pd.date_range(
+    window = pd.date_range(
         start=latest_date,
         end=datetime.today(),
         freq="D"
     )
+    # Days the data set already fully covers need no API calls; only
+    # missing or partially synced days are worth refetching
+    present = df.index.intersection(window)
+    complete = present[df.loc[present].notna().all(axis=1)]
+    date_range = window.difference(complete)
+    if date_range.empty:
+        log.info("All days in the window are already populated.")
+        return pd.DataFrame(), requests
+    rows: list[dict] = []
     try:
+        # Steps and heart support range queries, so the whole window
+        # costs two requests instead of two per date
+        steps = get_steps_data(client, date_range[0], date_range[-1])
+        heart = get_heart_data(client, date_range[0], date_range[-1])
+        requests += 2
         for date in date_range:
-            row, curr = get_row_of_data(client, date)
+            row, curr = get_row_of_data(client, date, steps, heart)
             requests += curr
-            if isinstance(row, pd.DataFrame):
-                df = pd.concat([df, row])
+            if row:
+                rows.append(row)
     except fitbit.exceptions.HTTPTooManyRequests:
         log.warning(f"Reached rate limit on this run.")
-    df = df[~df.index.duplicated(keep="last")]
-    return df, requests
+    if not rows:
+        return pd.DataFrame(), requests
+    new_df = pd.DataFrame(rows)
+    new_df.rename(columns=COLUMNS, inplace=True)
+    new_df["Date"] = pd.to_datetime(new_df["Date"])
+    new_df.set_index("Date", inplace=True)
+    new_df = new_df.reindex(columns=list(DTYPES))
+    new_df["Steps"] = pd.to_numeric(new_df["Steps"])
+    # Blank out bogus readings in one vectorized pass: a zero step
+    # count or a sleep/body group with any non-positive value means
+    # the tracker had nothing for that day
+    new_df.loc[new_df["Steps"] == 0, "Steps"] = pd.NA
+    for group in (SLEEP_COLUMNS, BODY_COLUMNS):
+        valid = (new_df[group] > 0).all(axis=1)
+        new_df.loc[~valid, group] = pd.NA
+    new_df.dropna(how="all", inplace=True)
+    new_df = new_df.astype(DTYPES)
+    new_df.sort_index(kind="stable", inplace=True)
+    return new_df, requests
+
+
+def make_client() -> fitbit.Fitbit:
+    """
+    Builds a Fitbit client from the tokens currently in the environment.
+
+    :return: the configured client
+    """
+    expires_at = float(os.environ.get("FITBIT_EXPIRES_AT", 0))
+    if expires_at > time.time() + 60:
+        log.info("Access token is still valid; skipping refresh.")
+    client = fitbit.Fitbit(
+        os.environ.get("FITBIT_CLIENT_ID"),
+        os.environ.get("FITBIT_CLIENT_SECRET"),
+        access_token=os.environ.get("FITBIT_ACCESS_TOKEN"),
+        refresh_token=os.environ.get("FITBIT_REFRESH_TOKEN"),
+        expires_at=expires_at,
+        refresh_cb=refresh_cb
+    )
+    client.client.session.mount("https://", make_adapter())
+    return client
 
 
 def main():
@@ -270,23 +501,24 @@ def main():
 
     # Initiate the Fitbit API
     log.info("Initiating Fitbit API.")
-    client = fitbit.Fitbit(
-        os.environ.get("FITBIT_CLIENT_ID"),
-        os.environ.get("FITBIT_CLIENT_SECRET"),
-        access_token=os.environ.get("FITBIT_ACCESS_TOKEN"),
-        refresh_token=os.environ.get("FITBIT_REFRESH_TOKEN"),
-        refresh_cb=refresh_cb
-    )
+    client = make_client()
+
+    # Probe the token so a stale one costs a refresh, not a full re-auth
+    try:
+        client.user_profile_get()
+    except fitbit.exceptions.HTTPUnauthorized:
+        log.warning("Access token was rejected; refreshing.")
+        if not refresh_access_token():
+            raise
+        client = make_client()
 
     # Collect data
-    latest_df, requests = get_latest_data(client)
+    new_df, requests = get_latest_data(client)
     log.info(f"Made {requests} requests while updating the data.")
-    log.info(f"Finalized the latest data collection:\n{latest_df}")
+    log.info(f"Finalized the latest data collection:\n{new_df}")
 
     # Backup data
-    latest_df.to_csv("fitbit.csv")
-    commit_csv()
-    os.remove("fitbit.csv")
+    commit_csv(new_df)
 
 
 if __name__ == "__main__":
@@ -306,8 +538,11 @@ if __name__ == "__main__":
 
     try:
         main()
-    except Exception as e:
+    except (fitbit.exceptions.HTTPUnauthorized, OAuth2Error) as e:
         log.exception(e)
         code = automate_code_retrieval()
         automate_token_retrieval(code)
         main()
+    except Exception as e:
+        log.exception(e)
+        raise